@@ -1,11 +1,43 @@
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
 import os
+import base64
+import time
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from getpass import getpass
 from datetime import datetime
-import json
+import orjson
+import ijson
+import re
 import shutil
 from bs4 import BeautifulSoup
 
+GRAPH_BATCH_LIMIT = 20  # Maximum number of requests Graph accepts in a single $batch call
+STREAM_THRESHOLD = 4 * 1024 * 1024  # Attachments larger than this are streamed to disk instead of batched
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+MAX_CONCURRENT_REQUESTS = 4  # Graph allows 4 concurrent requests per app against a mailbox
+DISK_WRITE_WORKERS = 2
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Shared session so every Graph and login call reuses pooled keep-alive connections
+session = requests.Session()
+session.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=MAX_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods={"GET", "POST"},  # The only POSTs are the token request and $batch of GETs
+        respect_retry_after_header=True
+    )
+))
+
+
 def get_access_token(client_id: str, client_secret: str, tenant_id: str) -> str:
     """Obtain the access token using client credentials flow.
 
@@ -25,18 +57,145 @@ def get_access_token(client_id: str, client_secret: str, tenant_id: str) -> str:
         "scope": "https://graph.microsoft.com/.default"
     }
 
-    response = requests.post(url, data=data)
+    response = session.post(url, data=data)
     response.raise_for_status()
-    access_token = response.json()["access_token"]
+    access_token = orjson.loads(response.content)["access_token"]
     return access_token
 
 def extract_text_from_html(html):
     """Extract text content from HTML."""
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = BeautifulSoup(html, 'lxml')
     text = soup.get_text(separator=' ')
     return text.strip()
 
 
+def write_attachment(attachment_path: str, data: bytes) -> None:
+    """Write downloaded attachment bytes to disk."""
+    # Write to a temporary file first so a failed write never leaves a partial PDF behind
+    fd, temp_path = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(attachment_path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, attachment_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def download_attachment_batch(downloads: list[tuple[str, str]], writer: ThreadPoolExecutor) -> list[Future]:
+    """Download up to GRAPH_BATCH_LIMIT attachments through the Microsoft Graph $batch endpoint.
+
+    Args:
+        downloads (list[tuple[str, str]]): Pairs of relative attachment $value URL and destination path.
+        writer (ThreadPoolExecutor): Executor the decoded files are handed to for writing.
+
+    Returns:
+        list[Future]: Pending writes of the downloaded attachments.
+    """
+    pending = dict(enumerate(downloads))
+    writes = []
+
+    for attempt in range(MAX_RETRIES):
+        batch = {
+            "requests": [
+                {"id": str(index), "method": "GET", "url": url}
+                for index, (url, _) in pending.items()
+            ]
+        }
+
+        response = session.post(
+            "https://graph.microsoft.com/v1.0/$batch",
+            data=orjson.dumps(batch),
+            headers={"Content-Type": "application/json"}
+        )
+        response.raise_for_status()
+
+        # Binary $value bodies come back base64 encoded inside the batch response
+        throttled: dict = {}
+        retry_after = 2 ** attempt
+        for result in orjson.loads(response.content)["responses"]:
+            index = int(result["id"])
+            url, attachment_path = pending[index]
+            if result["status"] in RETRY_STATUSES:
+                throttled[index] = pending[index]
+                retry_after = max(retry_after, int(result.get("headers", {}).get("Retry-After", 0)))
+                continue
+            if result["status"] != 200:
+                print(f"Failed to download {url}: HTTP {result['status']}")
+                continue
+
+            writes.append(writer.submit(write_attachment, attachment_path, base64.b64decode(result["body"])))
+
+        pending = throttled
+        if not pending:
+            return writes
+        if attempt < MAX_RETRIES - 1:
+            time.sleep(retry_after)
+
+    for url, _ in pending.values():
+        print(f"Failed to download {url}: retries exhausted")
+    return writes
+
+
+def download_attachment_streamed(url: str, attachment_path: str) -> None:
+    """Stream a single attachment to disk in fixed-size chunks.
+
+    Args:
+        url (str): Relative attachment $value URL.
+        attachment_path (str): Destination path.
+    """
+    # Stream into a temporary file so a failed transfer never leaves a truncated PDF behind
+    fd, temp_path = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(attachment_path))
+    try:
+        with os.fdopen(fd, "wb") as f, \
+                session.get(f"https://graph.microsoft.com/v1.0{url}", stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    os.replace(temp_path, attachment_path)
+
+
+def iter_messages(url: str, params: dict):
+    """Yield messages across all result pages, parsing each page incrementally.
+
+    Pages are read from the response stream with ijson, so a large page with expanded
+    attachments is never held in memory as a whole.
+
+    Args:
+        url (str): Messages endpoint URL.
+        params (dict): Query options for the first page.
+
+    Yields:
+        dict: A single message.
+    """
+    while url:
+        # Ask Graph to convert bodies to plain text so they need no HTML parsing here
+        with session.get(url, params=params, headers={"Prefer": 'outlook.body-content-type="text"'}, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+
+            next_link = None
+            builder = None
+            for prefix, event, value in ijson.parse(response.raw):
+                if prefix == "@odata.nextLink":
+                    next_link = value
+                elif prefix == "value.item" and event == "start_map":
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                elif builder is not None:
+                    builder.event(event, value)
+                    if prefix == "value.item" and event == "end_map":
+                        yield builder.value
+                        builder = None
+
+        # The next link already carries the query options
+        url, params = next_link, None
+
+
 def download_office365_attachments(access_token: str, start_date: datetime.date, start_time: datetime.time) -> tuple[dict, dict]:
     """Download attachments from Office 365 emails and extract relevant information.
 
@@ -56,54 +215,57 @@ def download_office365_attachments(access_token: str, start_date: datetime.date,
     mail_dict: dict = {}
     attachment_dict: dict = {}
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    session.headers.update({"Authorization": f"Bearer {access_token}"})
 
     try:
         # Fetch the shared mailbox emails using Microsoft Graph API
         url = "https://graph.microsoft.com/v1.0/users/sharedmailbox@domain.com/messages"
         params = {
-            "$filter": f"receivedDateTime ge {start_date}T{start_time}Z",
-            "$top": 100  # Adjust the page size as per your requirements
+            "$filter": f"receivedDateTime ge {start_date}T{start_time}Z and hasAttachments eq true",
+            "$top": 999,  # Largest page Graph serves for messages, keeping nextLink round-trips to a minimum
+            "$select": "id,subject,sender,receivedDateTime,body,hasAttachments",
+            "$expand": "attachments($select=id,name,contentType,size)"
         }
 
-        while True:
-            response = requests.get(url, headers=headers, params=params)
-            response.raise_for_status()
-            messages = response.json()["value"]
-
-            for message in messages:
-                email_id = message["id"]
+        # Disk writes go to their own pool so batch workers can move on to the next request
+        with ThreadPoolExecutor(max_workers=DISK_WRITE_WORKERS) as writer, \
+                ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            stream_futures = []
+            batch_futures = []
+            downloads: list[tuple[str, str]] = []
+            queued: set[str] = set()
 
-                # Fetch the email details
-                url = f"https://graph.microsoft.com/v1.0/users/sharedmailbox@domain.com/messages/{email_id}"
-                response = requests.get(url, headers=headers)
-                response.raise_for_status()
-                email_data = response.json()
+            for email_data in iter_messages(url, params):
+                email_id = email_data["id"]
 
                 attachments = []
                 for attachment in email_data.get("attachments", []):
                     attachment_name = attachment["name"]
                     content_type = attachment["contentType"]
 
-                    file_extension = os.path.splitext(attachment_name)[1].lower()
-                    if file_extension == ".pdf":
+                    # Some senders label PDFs as application/octet-stream, so the extension still counts
+                    if content_type == "application/pdf" or attachment_name.lower().endswith(".pdf"):
                         attachments.append(attachment_name)
 
-                        # Download the attachment
-                        url = f"https://graph.microsoft.com/v1.0/users/sharedmailbox@domain.com/messages/{email_id}/attachments/{attachment['id']}/$value"
-                        headers = {
-                                        "Authorization": f"Bearer {access_token}",
-                                        "Content-Type": "application/octet-stream"
-                                    }
-                        response = requests.get(url, headers=headers, stream=True)
-                        response.raise_for_status()
+                        # Only the first email carrying a filename is downloaded, matching the email
+                        # filter_office365_attachments classifies it by; concurrent downloads of a
+                        # repeated name would otherwise race for the same path
+                        if attachment_name in queued:
+                            continue
+                        queued.add(attachment_name)
 
+                        # Queue the attachment for a batched download, streaming large files separately
+                        attachment_url = f"/users/sharedmailbox@domain.com/messages/{email_id}/attachments/{attachment['id']}/$value"
                         attachment_path = os.path.join(path, attachment_name)
-                        with open(attachment_path, "wb") as f:
-                            f.write(response.content)
+                        if attachment.get("size", 0) > STREAM_THRESHOLD:
+                            stream_futures.append(executor.submit(download_attachment_streamed, attachment_url, attachment_path))
+                        else:
+                            downloads.append((attachment_url, attachment_path))
+
+                        # Send off full batches while the rest of the page is still being parsed
+                        if len(downloads) == GRAPH_BATCH_LIMIT:
+                            batch_futures.append(executor.submit(download_attachment_batch, downloads, writer))
+                            downloads = []
 
                 # Extract relevant email information
                 sender = email_data["sender"]["emailAddress"]["address"]
@@ -111,7 +273,8 @@ def download_office365_attachments(access_token: str, start_date: datetime.date,
                 subject = email_data["subject"]
                 body = email_data["body"]["content"]
 
-                if email_data["body"]["contentType"] == "text/html":
+                # Fallback in case the Prefer header was not honoured
+                if email_data["body"]["contentType"] == "html":
                     body = extract_text_from_html(body)
 
                 # Add email information to mail_dict only if it has PDF attachments
@@ -125,16 +288,21 @@ def download_office365_attachments(access_token: str, start_date: datetime.date,
 
                 attachment_dict[email_id] = attachments
 
-            # Check if there are more pages of emails
-            next_link = response.json().get("@odata.nextLink")
-            if not next_link:
-                break
+            # Send whatever remains as a final, partial batch
+            if downloads:
+                batch_futures.append(executor.submit(download_attachment_batch, downloads, writer))
 
-            url = next_link
+            # Let every download and the writes it queued finish before surfacing the first error
+            wait(stream_futures + batch_futures)
+            writes = [write for future in batch_futures if future.exception() is None for write in future.result()]
+            wait(writes)
+            for future in stream_futures + batch_futures + writes:
+                future.result()
 
         return mail_dict, attachment_dict
 
-    except requests.exceptions.RequestException as e:
+    # Pages are parsed straight off response.raw, so dropped connections surface as urllib3 errors
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, orjson.JSONDecodeError, ijson.JSONError) as e:
         print("An error occurred:", e)
         return mail_dict, attachment_dict
 
@@ -161,54 +329,47 @@ def filter_office365_attachments(mail_dict: dict, attachment_dict: dict) -> None
 
     path = os.path.join(os.getcwd(), "Attachments")
 
-    for attachment in os.listdir(path):
-        matching_keys = []
-        for key, value in attachment_dict.items():
-            if any(attachment in string for string in value):
-                matching_keys.append(key)
-
-        for key in matching_keys:
-            def bodyTitleCheck() -> str | bool:
-                for title in BodyTitle_filter:
-                    if mail_dict[key]['body'].startswith(title):
-                        return title
-                return False
-
-            def subjectCheck() -> str | bool:
-                for subject in Subject_filter:
-                    if mail_dict[key]['subject'].find(subject) != -1:
-                        return subject
-                return False
-
-            if (sub := subjectCheck()):
-                with open('PortfoliosPath.json') as file:
-                    data = json.load(file)
-                    destination_path = data[Subject_filter[sub]]
-                    os.makedirs(destination_path, exist_ok=True)
-                    shutil.copy(os.path.join(path, attachment), destination_path)
-                    os.remove(os.path.join(path, attachment))
-
-            elif (tc := bodyTitleCheck()):
-                with open('PortfoliosPath.json') as file:
-                    data = json.load(file)
-                    destination_path = data[BodyTitle_filter[tc]]
-                    os.makedirs(destination_path, exist_ok=True)
-                    shutil.copy(os.path.join(path, attachment), destination_path)
-                    os.remove(os.path.join(path, attachment))
-
-            elif ((doc := os.path.splitext(attachment)[0]) in DocName_filter):
-                with open('PortfoliosPath.json') as file:
-                    data = json.load(file)
-                    destination_path = data[DocName_filter[doc]]
-                    os.makedirs(destination_path, exist_ok=True)
-                    shutil.copy(os.path.join(path, attachment), destination_path)
-                    os.remove(os.path.join(path, attachment))
-
-            else:
-                # Move to a separate folder for unclassified attachments
-                unclassified_path = os.path.join(path, "Unclassified")
-                os.makedirs(unclassified_path, exist_ok=True)
-                shutil.move(os.path.join(path, attachment), unclassified_path)
+    with open('PortfoliosPath.json', 'rb') as file:
+        portfolio_paths = orjson.loads(file.read())
+
+    # Map each attachment filename to the first email it arrived in; the file is moved once classified
+    attachment_emails: dict = {}
+    for key, names in attachment_dict.items():
+        for name in names:
+            attachment_emails.setdefault(name, key)
+
+    # Each filter becomes a single alternation so a subject or body is scanned once for all keys
+    subject_pattern = re.compile('|'.join(map(re.escape, Subject_filter)))
+    body_title_pattern = re.compile('|'.join(map(re.escape, BodyTitle_filter)))
+
+    # Snapshot the directory up front since files are moved out of it while classifying
+    for entry in list(os.scandir(path)):
+        attachment = entry.name
+        if not entry.is_file() or (key := attachment_emails.get(attachment)) is None:
+            continue
+
+        src_path = entry.path
+
+        if (sub := subject_pattern.search(mail_dict[key]['subject'])):
+            destination_path = portfolio_paths[Subject_filter[sub.group()]]
+            os.makedirs(destination_path, exist_ok=True)
+            shutil.move(src_path, os.path.join(destination_path, attachment))
+
+        elif (tc := body_title_pattern.match(mail_dict[key]['body'])):
+            destination_path = portfolio_paths[BodyTitle_filter[tc.group()]]
+            os.makedirs(destination_path, exist_ok=True)
+            shutil.move(src_path, os.path.join(destination_path, attachment))
+
+        elif ((doc := os.path.splitext(attachment)[0]) in DocName_filter):
+            destination_path = portfolio_paths[DocName_filter[doc]]
+            os.makedirs(destination_path, exist_ok=True)
+            shutil.move(src_path, os.path.join(destination_path, attachment))
+
+        else:
+            # Move to a separate folder for unclassified attachments
+            unclassified_path = os.path.join(path, "Unclassified")
+            os.makedirs(unclassified_path, exist_ok=True)
+            shutil.move(src_path, unclassified_path)
 
     # Remove the "Attachments" folder if empty
     if not os.listdir(path):